@@ -9,21 +9,38 @@ Commands
 Daily
   22:00 SGT             • group recap: every user, their foods & totals
 Multi-group
-  Works in any chat: IDs are learned automatically
+  Works in any chat: each chat with entries today gets its own recap
 Security
   BOT TOKEN **MUST** be supplied via the TB_TOKEN environment variable
   (optionally from a local .env file that is never committed).
 """
 from __future__ import annotations
 
+import functools
+import io
 import os
+import queue
+import re
 import sqlite3
+import threading
+import time
 import datetime as dt
 import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterator
 from zoneinfo import ZoneInfo
 
+from apscheduler.executors.pool import ThreadPoolExecutor as ApsPool
+from apscheduler.jobstores.memory import MemoryJobStore
 from apscheduler.schedulers.background import BackgroundScheduler
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import telebot
+from telebot import apihelper
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery, Message
 
 # ──────────────────────────────────── SECRETS ─────────────────────────────────── #
@@ -39,6 +56,15 @@ TOKEN = os.environ["TB_TOKEN"]  # raises KeyError if not set!
 
 BOT = telebot.TeleBot(TOKEN, parse_mode="HTML")
 
+# One keep-alive session for every Bot API call, so replies and the nightly
+# fan-out reuse open TLS connections instead of handshaking each time.
+apihelper.session = requests.Session()
+apihelper.session.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                max_retries=Retry(total=3, backoff_factor=0.2)),
+)
+
 # ──────────────────────────────────── SETTINGS ────────────────────────────────── #
 DB_FILE       = "kcal.db"
 TZ            = ZoneInfo("Asia/Singapore")
@@ -46,76 +72,173 @@ TZ            = ZoneInfo("Asia/Singapore")
 QUIET_START   = 22         # 22:00 inclusive
 QUIET_END     = 0          # 00:00 exclusive
 SUMMARY_HOUR  = 22         # when daily group recap is sent
+DB_POOL_SIZE  = 8          # long-lived SQLite connections shared by handlers
+RECAP_WORKERS = 8          # parallel sends during the nightly recap
 
 # ──────────────────────────────── DB HELPERS ─────────────────────────────────── #
-def db() -> sqlite3.Connection:
-    return sqlite3.connect(DB_FILE, isolation_level=None)
+# Connections are opened once and reused so SQLite keeps its parsed schema and
+# page cache warm between commands. The queue hands each connection to one
+# thread at a time, so no extra locking is needed around it.
+_POOL: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+_POOL_FILLED = False
+_POOL_LOCK = threading.Lock()
+
+def _connect() -> sqlite3.Connection:
+    c = sqlite3.connect(DB_FILE, isolation_level=None, check_same_thread=False)
+    # WAL lets the nightly recap read while /add writes; busy_timeout waits
+    # out brief lock contention instead of raising "database is locked".
+    c.executescript("""PRAGMA journal_mode=WAL;
+                       PRAGMA synchronous=NORMAL;
+                       PRAGMA busy_timeout=10000;
+                       PRAGMA temp_store=MEMORY;
+                       PRAGMA cache_size=-20000;""")
+    return c
+
+def _fill_pool() -> None:
+    global _POOL_FILLED
+    if _POOL_FILLED:
+        return
+    with _POOL_LOCK:
+        if _POOL_FILLED:
+            return
+        # Open every connection before publishing any, so a failure part-way
+        # leaves the pool empty and the next call simply retries.
+        conns = []
+        try:
+            for _ in range(DB_POOL_SIZE):
+                conns.append(_connect())
+        except Exception:
+            for c in conns:
+                c.close()
+            raise
+        for c in conns:
+            _POOL.put_nowait(c)
+        _POOL_FILLED = True
+
+@contextmanager
+def db() -> Iterator[sqlite3.Connection]:
+    _fill_pool()
+    c = _POOL.get()
+    try:
+        yield c
+    finally:
+        _POOL.put(c)
+
+_ENTRIES_DDL = """CREATE TABLE IF NOT EXISTS {name} (
+                    id       INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id  INTEGER,
+                    chat_id  INTEGER,
+                    ts_utc   INTEGER NOT NULL,   -- unix epoch seconds
+                    food     TEXT,
+                    kcal     INTEGER
+                  )"""
+
+def _migrate_ts_to_epoch(c: sqlite3.Connection) -> None:
+    """Rebuild `entries` if ts_utc still holds ISO-8601 TEXT (pre-epoch schema)."""
+    cols = {row[1]: row[2] for row in c.execute("PRAGMA table_info(entries)")}
+    if cols.get("ts_utc", "").upper() != "TEXT":
+        return
+    c.execute("BEGIN IMMEDIATE")
+    try:
+        # Unparseable timestamps fall back to 0 (1970) and will never show up
+        # in a "today" query again, so make the count visible.
+        (bad,) = c.execute("""SELECT COUNT(*) FROM entries
+                              WHERE strftime('%s', ts_utc) IS NULL""").fetchone()
+        if bad:
+            logging.warning("%d entries have unparseable ts_utc; storing them as 0", bad)
+        c.execute(_ENTRIES_DDL.format(name="entries_new"))
+        c.execute("""INSERT INTO entries_new (id, user_id, chat_id, ts_utc, food, kcal)
+                     SELECT id, user_id, chat_id,
+                            COALESCE(CAST(strftime('%s', ts_utc) AS INTEGER), 0),
+                            food, kcal
+                     FROM entries""")
+        c.execute("DROP TABLE entries")
+        c.execute("ALTER TABLE entries_new RENAME TO entries")
+        c.execute("COMMIT")
+    except Exception:
+        c.execute("ROLLBACK")
+        raise
+    logging.info("Migrated entries.ts_utc to epoch seconds")
 
 def init_db() -> None:
     with db() as c:
-        c.execute("""CREATE TABLE IF NOT EXISTS entries (
-                       id       INTEGER PRIMARY KEY AUTOINCREMENT,
-                       user_id  INTEGER,
-                       chat_id  INTEGER,
-                       ts_utc   TEXT,
-                       food     TEXT,
-                       kcal     INTEGER
-                     )""")
-        c.execute("""CREATE TABLE IF NOT EXISTS chats (
-                       chat_id INTEGER PRIMARY KEY
-                     )""")
-
-def register_chat(chat_id: int) -> None:
-    with db() as c:
-        c.execute("INSERT OR IGNORE INTO chats VALUES (?)", (chat_id,))
-
-def _today_range() -> tuple[str, str]:
-    start = dt.datetime.combine(now_sgt().date(), dt.time.min, TZ).astimezone(dt.UTC)
+        c.execute(_ENTRIES_DDL.format(name="entries"))
+        _migrate_ts_to_epoch(c)
+        # Today's-range lookups; food/kcal are included so /summary and
+        # /remove are served from the index alone.
+        c.execute("""CREATE INDEX IF NOT EXISTS ix_entries_chat_user_ts
+                     ON entries (chat_id, user_id, ts_utc, food, kcal)""")
+        # The nightly recap scans today's entries across all chats.
+        c.execute("""CREATE INDEX IF NOT EXISTS ix_entries_ts
+                     ON entries (ts_utc)""")
+        # Only the per-chat recap query used this; it is gone now.
+        c.execute("DROP INDEX IF EXISTS ix_entries_chat_ts")
+
+# (SGT date, (start, end)) – recomputed only when the date rolls over.
+_RANGE_CACHE: tuple[dt.date, tuple[int, int]] | None = None
+
+def _today_range() -> tuple[int, int]:
+    global _RANGE_CACHE
+    today = now_sgt().date()
+    cached = _RANGE_CACHE
+    if cached is not None and cached[0] == today:
+        return cached[1]
+    start = dt.datetime.combine(today, dt.time.min, TZ)
     end   = start + dt.timedelta(days=1)
-    return start.isoformat(), end.isoformat()
+    rng = (int(start.timestamp()), int(end.timestamp()))
+    _RANGE_CACHE = (today, rng)
+    return rng
 
 def add_entry(uid: int, cid: int, food: str, kcal: int) -> None:
     with db() as c:
         c.execute("""INSERT INTO entries (user_id, chat_id, ts_utc, food, kcal)
                      VALUES (?,?,?,?,?)""",
-                  (uid, cid, dt.datetime.utcnow().isoformat(), food, kcal))
+                  (uid, cid, time.time_ns() // 1_000_000_000, food, kcal))
 
 def todays_entries(uid: int, cid: int) -> list[tuple[int, str, int]]:
     start, end = _today_range()
     with db() as c:
         return c.execute("""SELECT id, food, kcal FROM entries
                             WHERE user_id=? AND chat_id=? AND
-                                  ts_utc BETWEEN ? AND ?
+                                  ts_utc >= ? AND ts_utc < ?
                             ORDER BY id""",
                          (uid, cid, start, end)).fetchall()
 
-def delete_entry(row_id: int) -> None:
+def delete_entry(row_id: int) -> tuple[str, int] | None:
+    """Delete one entry; returns its (food, kcal), or None if it was already gone."""
     with db() as c:
-        c.execute("DELETE FROM entries WHERE id=?", (row_id,))
+        rows = c.execute("DELETE FROM entries WHERE id=? RETURNING food, kcal",
+                         (row_id,)).fetchall()
+    return rows[0] if rows else None
 
-def reset_today(uid: int, cid: int) -> None:
+def reset_today(uid: int, cid: int) -> int:
     start, end = _today_range()
     with db() as c:
-        c.execute("""DELETE FROM entries
-                     WHERE user_id=? AND chat_id=? AND
-                           ts_utc BETWEEN ? AND ?""",
-                  (uid, cid, start, end))
+        return c.execute("""DELETE FROM entries
+                            WHERE user_id=? AND chat_id=? AND
+                                  ts_utc >= ? AND ts_utc < ?""",
+                         (uid, cid, start, end)).rowcount
 
-def day_details(cid: int) -> dict[int, list[tuple[str, int]]]:
+def all_day_details() -> dict[int, dict[int, tuple[int, list[tuple[str, int]]]]]:
+    """Today's entries for every chat in one query.
+
+    Returns {chat_id: {user_id: (subtotal, [(food, kcal), ...])}}; subtotals are
+    summed by SQLite alongside the rows.
+    """
     start, end = _today_range()
     with db() as c:
-        rows = c.execute("""SELECT user_id, food, kcal FROM entries
-                            WHERE chat_id=? AND ts_utc BETWEEN ? AND ?""",
-                         (cid, start, end)).fetchall()
-    out: dict[int, list[tuple[str, int]]] = {}
-    for uid, food, kcal in rows:
-        out.setdefault(uid, []).append((food, kcal))
+        rows = c.execute("""SELECT chat_id, user_id, food, kcal,
+                                   SUM(kcal) OVER (PARTITION BY chat_id, user_id)
+                            FROM entries
+                            WHERE ts_utc >= ? AND ts_utc < ?
+                            ORDER BY chat_id, user_id, id""",
+                         (start, end)).fetchall()
+    out: dict[int, dict[int, tuple[int, list[tuple[str, int]]]]] = {}
+    for (cid, uid), grp in groupby(rows, key=itemgetter(0, 1)):
+        items = [row[2:] for row in grp]
+        out.setdefault(cid, {})[uid] = (items[0][2], [(food, kcal) for food, kcal, _ in items])
     return out
 
-def all_chat_ids() -> list[int]:
-    with db() as c:
-        return [row[0] for row in c.execute("SELECT chat_id FROM chats")]
-
 # ─────────────────────────────── UTILITIES ───────────────────────────────────── #
 def now_sgt() -> dt.datetime:
     return dt.datetime.now(TZ)
@@ -123,17 +246,27 @@ def now_sgt() -> dt.datetime:
 def in_quiet_window(ts: dt.datetime) -> bool:
     return ts.hour >= QUIET_START or ts.hour < QUIET_END
 
+_HTML_SPECIAL = frozenset("<>&")
+
+def escape_html(text: str) -> str:
+    """telebot.util.escape, skipped for the common case of nothing to escape."""
+    if _HTML_SPECIAL.isdisjoint(text):
+        return text
+    return telebot.util.escape(text)
+
 def mention_html(user) -> str:
-    name = telebot.util.escape(user.first_name or "user")
+    name = escape_html(user.first_name or "user")
     return f'<a href="tg://user?id={user.id}">{name}</a>'
 
+@functools.lru_cache(maxsize=4096)
+def _user_link(uid: int) -> str:
+    return f'<a href="tg://user?id={uid}">User</a>'
+
 # ─────────────────────────────── COMMANDS ────────────────────────────────────── #
 # ────────── /add ────────── #
 @BOT.message_handler(commands=['add'])
 def cmd_add(msg: Message):
     """ /add <food name> <kcals>  → log an entry """
-    register_chat(msg.chat.id)
-
     # Block logging during the quiet window (22:00–00:00)
     if in_quiet_window(now_sgt()):
         BOT.reply_to(msg, "you fat fuck why did u eat")
@@ -162,13 +295,12 @@ def cmd_add(msg: Message):
     BOT.reply_to(
         msg,
         f"Added for {mention_html(msg.from_user)}: "
-        f"<b>{telebot.util.escape(food)}</b> – <b>{kcal}</b> kcal ✔️"
+        f"<b>{escape_html(food)}</b> – <b>{kcal}</b> kcal ✔️"
     )
 
 
 @BOT.message_handler(commands=["remove"])
 def cmd_remove(msg: Message) -> None:
-    register_chat(msg.chat.id)
     rows = todays_entries(msg.from_user.id, msg.chat.id)
     if not rows:
         BOT.reply_to(msg, "Nothing to remove today.")
@@ -184,61 +316,74 @@ def cmd_remove(msg: Message) -> None:
         )
     BOT.reply_to(msg, "Tap an item to delete it:", reply_markup=kb)
 
-@BOT.callback_query_handler(func=lambda q: q.data.startswith("del:"))
+_DEL_RE = re.compile(r"del:(\d+)$")
+
+@BOT.callback_query_handler(func=lambda q: _DEL_RE.match(q.data) is not None)
 def cb_delete(q: CallbackQuery) -> None:
-    delete_entry(int(q.data.split(":", 1)[1]))
+    row = delete_entry(int(_DEL_RE.match(q.data)[1]))
+    if row is None:
+        BOT.answer_callback_query(q.id, "Already removed")
+        BOT.edit_message_text("Already deleted.", q.message.chat.id, q.message.id)
+        return
+    food, kcal = row
     BOT.answer_callback_query(q.id, "Entry removed ✅")
-    BOT.edit_message_text("Deleted.", q.message.chat.id, q.message.id)
+    BOT.edit_message_text(f"Deleted <b>{escape_html(food)}</b> – {kcal} kcal",
+                          q.message.chat.id, q.message.id)
 
 @BOT.message_handler(commands=["summary"])
 def cmd_summary(msg: Message) -> None:
-    register_chat(msg.chat.id)
     rows = todays_entries(msg.from_user.id, msg.chat.id)
     if not rows:
         BOT.reply_to(msg, "No entries yet today.")
         return
     total = sum(k for _, _, k in rows)
     lines = [f"Your log for {now_sgt().date()}  –  {total} kcal"]
-    lines += [f" • {food} – {kcal}" for _, food, kcal in rows]
+    lines += [f" • {escape_html(food)} – {kcal}" for _, food, kcal in rows]
     BOT.reply_to(msg, "\n".join(lines))
 
 @BOT.message_handler(commands=["reset"])
 def cmd_reset(msg: Message) -> None:
-    register_chat(msg.chat.id)
-    reset_today(msg.from_user.id, msg.chat.id)
+    if not reset_today(msg.from_user.id, msg.chat.id):
+        BOT.reply_to(msg, "Nothing to clear today.")
+        return
     BOT.reply_to(msg, "Today's entries cleared. Start fresh! 🎯")
 
 # ─────────────────────────────── SCHEDULER ──────────────────────────────────── #
-def send_chat_recap(cid: int) -> None:
-    det = day_details(cid)
-    if not det:
-        return
-    lines = [f"**Daily calorie recap ({now_sgt().date()})**"]
-    for uid, items in det.items():
-        subtotal = sum(k for _, k in items)
-        user_link = f'<a href="tg://user?id={uid}">User</a>'
-        lines.append(f"\n{user_link}: <b>{subtotal}</b> kcal")
+def send_chat_recap(cid: int, det: dict[int, tuple[int, list[tuple[str, int]]]]) -> None:
+    buf = io.StringIO()
+    buf.write(f"**Daily calorie recap ({now_sgt().date()})**")
+    for uid, (subtotal, items) in det.items():
+        buf.write(f"\n\n{_user_link(uid)}: <b>{subtotal}</b> kcal")
         for food, kcal in items:
-            lines.append(f" • {telebot.util.escape(food)} – {kcal}")
-    BOT.send_message(cid, "\n".join(lines), parse_mode="HTML")
+            buf.write(f"\n • {escape_html(food)} – {kcal}")
+    BOT.send_message(cid, buf.getvalue(), parse_mode="HTML")
+
+# Sends are network-bound, so overlapping them keeps one slow chat from
+# holding up the rest of the recap.
+EXEC = ThreadPoolExecutor(max_workers=RECAP_WORKERS, thread_name_prefix="recap")
 
 def nightly_job() -> None:
-    for cid in all_chat_ids():
+    # Chats with no entries today simply don't appear, so nothing is sent there.
+    futures = {EXEC.submit(send_chat_recap, cid, det): cid
+               for cid, det in all_day_details().items()}
+    for fut in as_completed(futures):
         try:
-            send_chat_recap(cid)
+            fut.result()
         except Exception as err:
-            logging.warning("Recap failed for %s: %s", cid, err)
+            logging.warning("Recap failed for %s: %s", futures[fut], err)
 
 def start_scheduler() -> None:
-    sched = BackgroundScheduler(timezone=str(TZ))
+    # Jobs live in memory so the scheduler never competes with the bot for the
+    # SQLite file; coalesce collapses runs missed while the host was asleep.
+    sched = BackgroundScheduler(
+        timezone=str(TZ),
+        jobstores={"default": MemoryJobStore()},
+        executors={"default": ApsPool(1)},
+        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": 300},
+    )
     sched.add_job(nightly_job, "cron", hour=SUMMARY_HOUR, minute=0)
     sched.start()
 
-# ─────────────────────—— PASSIVE CHAT REGISTRATION ─────────────────────────── #
-@BOT.message_handler(func=lambda _m: True, content_types=["text", "photo", "sticker", "video"])
-def seen_any(msg: Message) -> None:
-    register_chat(msg.chat.id)
-
 # ─────────────────────────────── MAIN ──────────────────────────────────────── #
 if __name__ == "__main__":
     logging.basicConfig(